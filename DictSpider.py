@@ -1,108 +1,252 @@
 import argparse
+import collections
 import concurrent.futures
-import itertools
 import logging
 import os
 import re
+import shutil
+import threading
+from collections.abc import Iterable
 from pathlib import Path
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from urllib3.util.request import ACCEPT_ENCODING
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# Respect CPU affinity (taskset/cpuset pinning) where the platform exposes it;
+# a CFS quota such as docker --cpus is not reflected here
+_DEFAULT_CONCURRENT_DOWNLOADS = (
+	len(os.sched_getaffinity(0))
+	if hasattr(os, "sched_getaffinity")
+	else os.cpu_count() or 1
+) * 2
+
+# For dictionaries like 天线行业/BSA
+_SOUGOU_NAME_TABLE = str.maketrans(dict.fromkeys("/,|\\'", "-"))
+
+
+def _class_regex(name: str):
+	"""Match name in a raw, space-separated class attribute.
+
+	Strainers used as parse_only see the class attribute before it is split,
+	so a plain string would only match elements whose class is exactly name.
+	"""
+	return re.compile(rf"(?:^|\s){re.escape(name)}(?:\s|$)")
+
+
+_SOUGOU_CATEGORY = SoupStrainer("div", class_=_class_regex("dict_category_list_title"))
+_SOUGOU_CITY_CATEGORY = SoupStrainer("div", class_=_class_regex("citylistcate"))
+_SOUGOU_DICT = SoupStrainer("div", class_=_class_regex("dict_detail_block"))
+_SOUGOU_DICT_TITLE = SoupStrainer("div", class_="detail_title")
+_SOUGOU_DICT_DL_BTN = SoupStrainer("div", class_="dict_dl_btn")
+_SOUGOU_RCMD_DICT = SoupStrainer("div", class_=_class_regex("rcmd_dict"))
+_SOUGOU_RCMD_DICT_TITLE = SoupStrainer("div", class_="rcmd_dict_title")
+_SOUGOU_RCMD_DICT_DL_BTN = SoupStrainer("div", class_="rcmd_dict_dl_btn")
+_BAIDU_CATEGORY = SoupStrainer(
+	"a", attrs={"data-stats": "webDictPage.dictSort.category1"}
+)
+_BAIDU_PAGE = SoupStrainer(
+	"a", href=re.compile(r"dict_list\?cid=(\d+)&page=(\d+)#page")
+)
+_BAIDU_DICT = SoupStrainer(
+	"a", href="javascript:void(0)", class_="dict-down dictClick", title="立即下载"
+)
+
 
 class DictSpider:
 	def __init__(
 		self,
 		sougou_save_path: Path = Path("sougou_dict"),
-		sougou_exclude_list: set[str] = set(),
+		sougou_exclude_list: Iterable[str] | None = None,
 		baidu_save_path: Path = Path("baidu_dict"),
-		baidu_exclude_list: set[str] = {"4206105738"},
-		concurrent_downloads: int = os.cpu_count() * 2,
+		baidu_exclude_list: Iterable[str] | None = None,
+		concurrent_downloads: int = _DEFAULT_CONCURRENT_DOWNLOADS,
 		max_retries: int = 5,
 		timeout: float = 60.0,
 		headers: dict[str, str] = {
 			"User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64; rv:60.0) Gecko/20100101 Firefox/60.0",
 			"Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
 			"Accept-Language": "zh-CN,zh;q=0.8,zh-TW;q=0.7,zh-HK;q=0.5,en-US;q=0.3,en;q=0.2",
-			"Accept-Encoding": "gzip, deflate",
+			# Also advertises br and zstd when urllib3 can decode them
+			"Accept-Encoding": ACCEPT_ENCODING,
 			"Connection": "keep-alive",
 		},
 	):
 		self.sougou_save_path = sougou_save_path
-		self.sougou_exclude_list = sougou_exclude_list
+		self.sougou_exclude_list = frozenset(sougou_exclude_list or ())
 		self.baidu_save_path = baidu_save_path
-		self.baidu_exclude_list = baidu_exclude_list
+		self.baidu_exclude_list = frozenset(
+			# 4206105738 (互猎网): page 404
+			{"4206105738"} if baidu_exclude_list is None else baidu_exclude_list
+		)
 		self.max_retries = max_retries
 		self.timeout = timeout
-		self.headers = headers
-		self.__executor = concurrent.futures.ThreadPoolExecutor(concurrent_downloads)
-		self.__futures: list[concurrent.futures.Future] = []
+		self.__session = requests.Session()
+		self.__session.headers.update(headers)
+		# The headers actually sent, so changing them still takes effect
+		self.headers = self.__session.headers
+		adapter = HTTPAdapter(
+			pool_maxsize=concurrent_downloads,
+			max_retries=Retry(
+				total=max_retries,
+				backoff_factor=0.5,
+				backoff_max=16,
+				backoff_jitter=1,
+				status_forcelist=(429, 500, 502, 503, 504),
+				allowed_methods=("GET",),
+				raise_on_status=False,
+			),
+		)
+		# Give plain HTTP requests the same pool and retry policy as HTTPS ones
+		self.__session.mount("http://", adapter)
+		self.__session.mount("https://", adapter)
+		self.__executor = concurrent.futures.ThreadPoolExecutor(
+			concurrent_downloads, thread_name_prefix="DictSpider"
+		)
+		self.__futures: collections.deque[concurrent.futures.Future] = (
+			collections.deque()
+		)
+		self.__lock = threading.Lock()
+		# Dictionary names already saved under any category, before this run
+		self.__on_disk: dict[str, list[Path]] = {}
+		# URL -> where it was saved, or the extra paths waiting for its download
+		self.__downloaded: dict[str, Path] = {}
+		self.__pending: dict[str, list[Path]] = {}
 
 	def __enter__(self):
 		self.__executor.__enter__()
 		return self
 
 	def __exit__(self, exc_type, exc_val, exc_tb):
-		return self.__executor.__exit__(exc_type, exc_val, exc_tb)
+		try:
+			return self.__executor.__exit__(exc_type, exc_val, exc_tb)
+		finally:
+			self.__session.close()
 
 	def __get_html(self, url: str):
-		with requests.Session() as session:
-			session.mount("https://", HTTPAdapter(max_retries=self.max_retries))
-			return session.get(url, headers=self.headers, timeout=self.timeout)
+		return self.__session.get(url, timeout=self.timeout)
+
+	def __get_soup(self, url: str, parse_only: SoupStrainer | None = None):
+		return BeautifulSoup(
+			self.__get_html(url).content, "lxml", parse_only=parse_only
+		)
+
+	def __find_all(self, url: str, strainer: SoupStrainer):
+		"""Only build the subtrees of the elements that are to be found"""
+		return self.__get_soup(url, strainer).find_all(strainer)
+
+	def __get_file(self, url: str, file_path: Path):
+		"""Stream the response body into file_path and return its size"""
+		with (
+			self.__session.get(url, timeout=self.timeout, stream=True) as response,
+			file_path.open("wb") as file,
+		):
+			for chunk in response.iter_content(64 * 1024):
+				file.write(chunk)
+			return file.tell()
 
-	def __download(self, name: str, url: str, category_path: Path):
-		file_path = category_path / name
-		if file_path.is_file():
+	def __download(self, file_path: Path, url: str):
+		part_path = file_path.with_name(file_path.name + ".part")
+		try:
+			size = self.__get_file(url, part_path)
+		except BaseException:
+			part_path.unlink(missing_ok=True)
+			raise
+		if not size:
+			# For dictionaries like 威海地名
+			# Leave the URL pending so that its other listings are skipped too
+			part_path.unlink()
+			log.warning(f"{file_path.name} is empty, skipping...")
+			return
+		part_path.replace(file_path)
+		log.info(f"{file_path.name} downloaded successfully.")
+		with self.__lock:
+			self.__downloaded[url] = file_path
+			waiting = self.__pending.pop(url)
+		for target_path in waiting:
+			self.__link(file_path, target_path)
+
+	def __link(self, source_path: Path, file_path: Path):
+		"""Save the already downloaded source_path as file_path too"""
+		if file_path == source_path:
+			return
+		try:
+			os.link(source_path, file_path)
+		except FileExistsError:
 			log.warning(f"{file_path} already exists, skipping...")
 			return
-		retries = 0
-		while not (content := self.__get_html(url).content):
-			if retries == 5:
-				# For dictionaries like 威海地名
-				log.warning(f"{name} is empty, skipping...")
-				return
-			retries += 1
-		file_path.write_bytes(content)
-		log.info(f"{name} downloaded successfully.")
+		except OSError:
+			# For file systems without hard links
+			shutil.copyfile(source_path, file_path)
+		log.info(f"{file_path.name} copied from {source_path}.")
+
+	def __scan_save_path(self, save_path: Path):
+		"""Record the dictionaries already saved under every category"""
+		on_disk: dict[str, list[Path]] = {}
+		for category in os.scandir(save_path):
+			if category.is_dir():
+				for entry in os.scandir(category):
+					on_disk.setdefault(entry.name, []).append(Path(entry.path))
+		with self.__lock:
+			self.__on_disk.update(on_disk)
+
+	def __submit_downloads(self, category_path: Path, dicts: Iterable[tuple[str, str]]):
+		"""Submit (name, url) pairs for downloading, once per URL"""
+		for name, url in dicts:
+			file_path = category_path / name
+			with self.__lock:
+				on_disk = self.__on_disk.get(name, [])
+				if file_path in on_disk:
+					source_path = file_path
+				elif (source_path := self.__downloaded.get(url)) is None:
+					if on_disk:
+						source_path = self.__downloaded[url] = on_disk[0]
+					elif (waiting := self.__pending.get(url)) is not None:
+						# For dictionaries listed under more than one category
+						waiting.append(file_path)
+						continue
+					else:
+						self.__pending[url] = []
+			if source_path is None:
+				self.__futures.append(
+					self.__executor.submit(self.__download, file_path, url)
+				)
+			elif source_path == file_path:
+				log.warning(f"{file_path} already exists, skipping...")
+			else:
+				self.__link(source_path, file_path)
 
 	def __sougou_download_page(self, page_url: str, category_path: Path):
-		self.__futures.extend(
-			self.__executor.submit(
-				self.__download,
+		self.__submit_downloads(
+			category_path,
+			(
 				(
-					# For dictionaries like 天线行业/BSA
-					dict_td_title.string.replace("/", "-")
-					.replace(",", "-")
-					.replace("|", "-")
-					.replace("\\", "-")
-					.replace("'", "-")
-					if dict_td_title.string
-					else ""  # For dictionaries without a name like index 15946
+					(
+						dict_td_title.string.translate(_SOUGOU_NAME_TABLE)
+						if dict_td_title.string
+						else ""  # For dictionaries without a name like index 15946
+					)
+					+ f"_{dict_td_id}.scel",
+					dict_td.find(_SOUGOU_DICT_DL_BTN).a["href"],
 				)
-				+ "_"
-				+ dict_td_id
-				+ ".scel",
-				dict_td.find("div", class_="dict_dl_btn").a["href"],
-				category_path,
-			)
-			for dict_td in BeautifulSoup(
-				self.__get_html(page_url).text, "html.parser"
-			).find_all("div", class_="dict_detail_block")
-			if (
-				dict_td_id := (
-					dict_td_title := dict_td.find("div", class_="detail_title").a
-				)["href"].rpartition("/")[-1]
-			)
-			not in self.sougou_exclude_list
+				for dict_td in self.__find_all(page_url, _SOUGOU_DICT)
+				if (
+					dict_td_id := (dict_td_title := dict_td.find(_SOUGOU_DICT_TITLE).a)[
+						"href"
+					].rpartition("/")[-1]
+				)
+				not in self.sougou_exclude_list
+			),
 		)
 
 	def __sougou_download_category(self, category: str, category_167: bool = False):
 		category_url = "https://pinyin.sogou.com/dict/cate/index/" + category
-		soup = BeautifulSoup(self.__get_html(category_url).text, "html.parser")
+		soup = self.__get_soup(category_url)
 		if not category_167:
 			category_path = self.sougou_save_path / (
 				soup.find("title").string.partition("_")[0] + "_" + category
@@ -116,10 +260,13 @@ class DictSpider:
 			or len(pages := page_list.find_all("a")) < 2
 			else int(pages[-2].string) + 1
 		)
+		# Free the full page tree now instead of leaving its cycles to the GC
+		soup.decompose()
+		page_url = category_url + "/default/{}"
 		self.__futures.extend(
 			self.__executor.submit(
 				self.__sougou_download_page,
-				category_url + "/default/" + str(page),
+				page_url.format(page),
 				category_path,
 			)
 			for page in range(1, page_n)
@@ -135,44 +282,53 @@ class DictSpider:
 				category_td.a["href"].rpartition("/")[-1],
 				True,
 			)
-			for category_td in BeautifulSoup(
-				self.__get_html("https://pinyin.sogou.com/dict/cate/index/180").text,
-				"html.parser",
-			).find_all("div", class_="citylistcate")
+			for category_td in self.__find_all(
+				"https://pinyin.sogou.com/dict/cate/index/180", _SOUGOU_CITY_CATEGORY
+			)
 		)
 
 	def __sougou_download_category_0(self):
 		"""For dictionaries that do not belong to any categories"""
 		category_path = self.sougou_save_path / "未分类_0"
 		category_path.mkdir(exist_ok=True)
-		self.__futures.append(
-			self.__executor.submit(
-				self.__download,
-				"网络流行新词【官方推荐】_4.scel",
-				"https://pinyin.sogou.com/d/dict/download_cell.php?id=4&name=网络流行新词【官方推荐】",
-				category_path,
-			)
+		self.__submit_downloads(
+			category_path,
+			[
+				(
+					"网络流行新词【官方推荐】_4.scel",
+					"https://pinyin.sogou.com/d/dict/download_cell.php?id=4&name=网络流行新词【官方推荐】",
+				)
+			],
 		)
-		self.__futures.extend(
-			self.__executor.submit(
-				self.__download,
+		self.__submit_downloads(
+			category_path,
+			(
 				(
-					dict_td_title := dict_td.find("div", class_="rcmd_dict_title").a
-				).string
-				+ "_"
-				+ dict_td_title["href"].rpartition("/")[-1]
-				+ ".scel",
-				"https:" + dict_td.find("div", class_="rcmd_dict_dl_btn").a["href"],
-				category_path,
+					(dict_td_title := dict_td.find(_SOUGOU_RCMD_DICT_TITLE).a).string
+					+ "_"
+					+ dict_td_title["href"].rpartition("/")[-1]
+					+ ".scel",
+					"https:" + dict_td.find(_SOUGOU_RCMD_DICT_DL_BTN).a["href"],
+				)
+				for dict_td in self.__find_all(
+					"https://pinyin.sogou.com/dict/detail/index/4", _SOUGOU_RCMD_DICT
+				)
+			),
+		)
+
+	def __sougou_all_categories(self):
+		"""Yield 0 before the category list is fetched so it starts downloading first"""
+		yield "0"
+		yield from (
+			category.a["href"].partition("?")[0].rpartition("/")[-1]
+			for category in self.__find_all(
+				"https://pinyin.sogou.com/dict/", _SOUGOU_CATEGORY
 			)
-			for dict_td in BeautifulSoup(
-				self.__get_html("https://pinyin.sogou.com/dict/detail/index/4").text,
-				"html.parser",
-			).find_all("div", class_="rcmd_dict")
 		)
 
 	def __sougou_download_dicts(self, categories: set[str] | None):
 		self.sougou_save_path.mkdir(parents=True, exist_ok=True)
+		self.__scan_save_path(self.sougou_save_path)
 		self.__futures.extend(
 			self.__executor.submit(self.__sougou_download_category_0)
 			if category == "0"
@@ -180,63 +336,43 @@ class DictSpider:
 			if category == "167"
 			else self.__executor.submit(self.__sougou_download_category, category)
 			for category in (
-				itertools.chain(
-					["0"],
-					(
-						category.a["href"].partition("?")[0].rpartition("/")[-1]
-						for category in BeautifulSoup(
-							self.__get_html("https://pinyin.sogou.com/dict/").text,
-							"html.parser",
-						).find_all("div", class_="dict_category_list_title")
-					),
-				)
-				if categories is None
-				else categories
+				self.__sougou_all_categories() if categories is None else categories
 			)
 		)
 
 	def __baidu_download_page(self, page_url: str, category_path: Path):
-		self.__futures.extend(
-			self.__executor.submit(
-				self.__download,
-				# For dictionaries like 汽车常用词/术语
-				dict_td["dict-name"].replace("/", "-") + "_" + dict_td_id + ".bdict",
-				"https://shurufa.baidu.com/dict_innerid_download?innerid=" + dict_td_id,
-				category_path,
-			)
-			for dict_td in BeautifulSoup(
-				self.__get_html(page_url).text, "html.parser"
-			).find_all(
-				"a",
-				href="javascript:void(0)",
-				class_="dict-down dictClick",
-				title="立即下载",
-			)
-			if (dict_td_id := dict_td["dict-innerid"]) not in self.baidu_exclude_list
+		self.__submit_downloads(
+			category_path,
+			(
+				(
+					# For dictionaries like 汽车常用词/术语
+					dict_td["dict-name"].replace("/", "-") + f"_{dict_td_id}.bdict",
+					f"https://shurufa.baidu.com/dict_innerid_download?innerid={dict_td_id}",
+				)
+				for dict_td in self.__find_all(page_url, _BAIDU_DICT)
+				if (dict_td_id := dict_td["dict-innerid"])
+				not in self.baidu_exclude_list
+			),
 		)
 
 	def __baidu_download_category(self, category: str):
 		category_url = "https://shurufa.baidu.com/dict_list?cid=" + category
-		soup = BeautifulSoup(self.__get_html(category_url).text, "html.parser")
+		soup = self.__get_soup(category_url)
 		category_path = self.baidu_save_path / (
 			soup.find("title").string.rpartition("-")[-1] + "_" + category
 		)
 		category_path.mkdir(exist_ok=True)
 		page_n = (
 			2
-			if (
-				pages := soup.find_all(
-					"a", href=re.compile(r"dict_list\?cid=(\d+)&page=(\d+)#page")
-				)
-			)
-			is None
-			or len(pages) < 2
+			if len(pages := soup.find_all(_BAIDU_PAGE)) < 2
 			else int(pages[-2].string) + 1
 		)
+		soup.decompose()
+		page_url = category_url + "&page={}"
 		self.__futures.extend(
 			self.__executor.submit(
 				self.__baidu_download_page,
-				category_url + "&page=" + str(page),
+				page_url.format(page),
 				category_path,
 			)
 			for page in range(1, page_n)
@@ -244,16 +380,14 @@ class DictSpider:
 
 	def __baidu_download_dicts(self, categories: set[str] | None):
 		self.baidu_save_path.mkdir(parents=True, exist_ok=True)
+		self.__scan_save_path(self.baidu_save_path)
 		self.__futures.extend(
 			self.__executor.submit(self.__baidu_download_category, category)
 			for category in (
 				(
 					category["href"].partition("=")[-1]
-					for category in BeautifulSoup(
-						self.__get_html("https://shurufa.baidu.com/dict").text,
-						"html.parser",
-					).find_all(
-						"a", attrs={"data-stats": "webDictPage.dictSort.category1"}
+					for category in self.__find_all(
+						"https://shurufa.baidu.com/dict", _BAIDU_CATEGORY
 					)
 				)
 				if categories is None
@@ -266,12 +400,16 @@ class DictSpider:
 		sougou_categories: set[str] | None = None,
 		baidu_categories: set[str] | None = None,
 	):
-		self.__futures = [
-			self.__executor.submit(self.__sougou_download_dicts, sougou_categories),
-			self.__executor.submit(self.__baidu_download_dicts, baidu_categories),
-		]
-		for future in self.__futures:
-			future.result()
+		self.__futures.extend(
+			(
+				self.__executor.submit(self.__sougou_download_dicts, sougou_categories),
+				self.__executor.submit(self.__baidu_download_dicts, baidu_categories),
+			)
+		)
+		# Tasks append the futures of their subtasks before completing, so once
+		# the deque runs empty every submitted task has finished
+		while self.__futures:
+			self.__futures.popleft().result()
 
 
 if __name__ == "__main__":
@@ -349,9 +487,10 @@ if __name__ == "__main__":
 	parser.add_argument(
 		"--concurrent-downloads",
 		"-j",
-		default=os.cpu_count() * 2,
+		default=_DEFAULT_CONCURRENT_DOWNLOADS,
 		type=int,
-		help="Set the number of parallel downloads.\n" "Default: os.cpu_count() * 2",
+		help="Set the number of parallel downloads.\n"
+		"Default: number of usable CPUs * 2",
 		metavar="N",
 	)
 	parser.add_argument(